@@ -1,37 +1,212 @@
-import asyncio
+import datetime
+import io
+import re
+from collections import OrderedDict
 from datetime import date, timedelta
+from decimal import Decimal
 import os
-from aiogram import Bot, Dispatcher, F
+from typing import Optional
+from cachetools import TTLCache
+import orjson
+import uvloop
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from sqlalchemy import Column, Integer, Float, Date, BigInteger, String, select, func
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import (
+    Date, BigInteger, String, Index, UniqueConstraint,
+    select, update, func, cast, bindparam, literal, null, tuple_, union_all,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 # --- Конфигурация ---
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+asyncpg://primer:primer@db:5432/economoney_db")
-DAILY_LIMIT = 2000
+DAILY_LIMIT = 2000 * 100  # суммы везде хранятся в копейках
+BALANCE_CACHE_SIZE = 10_000
+PENDING_TTL = 600
+PENDING_MAXSIZE = 100_000
+RUN_DDL = os.getenv("RUN_DDL") == "1"
+MAX_AMOUNT = 10**9 * 100  # миллиард рублей в копейках — с запасом до предела bigint
 
-Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, echo=False)
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+class Base(DeclarativeBase):
+    pass
+
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=20,
+    max_overflow=10,
+    # Кэш подготовленных запросов asyncpg на каждое соединение
+    connect_args={"prepared_statement_cache_size": 512},
+)
+async_session = async_sessionmaker(engine, expire_on_commit=False)
 
 # --- Модели ---
 class Expense(Base):
     __tablename__ = "expenses"
-    id = Column(Integer, primary_key=True)
-    user_id = Column(BigInteger, nullable=False)
-    amount = Column(Float, nullable=False)
-    date = Column(Date, nullable=False, default=date.today)
-    category = Column(String, nullable=True)
+    __table_args__ = (
+        # category и amount в INCLUDE — статистика читается только из индекса
+        Index(
+            "ix_expenses_user_date", "user_id", "date",
+            postgresql_include=["category", "amount"],
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger)
+    amount: Mapped[int] = mapped_column(BigInteger)  # копейки
+    # Атрибут date затеняет datetime.date внутри тела класса — тип берём через модуль
+    date: Mapped[datetime.date] = mapped_column(Date, default=datetime.date.today)
+    category: Mapped[Optional[str]]
 
 
 class Balance(Base):
     __tablename__ = "balances"
-    id = Column(Integer, primary_key=True)
-    user_id = Column(BigInteger, nullable=False)
-    date = Column(Date, nullable=False)
-    balance = Column(Float, nullable=False)
+    __table_args__ = (
+        # Индекс этого ограничения обслуживает и upsert, и поиск последнего баланса
+        # (ORDER BY date DESC LIMIT 1 — обратный проход по тому же btree)
+        UniqueConstraint("user_id", "date", name="uq_balances_user_date"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger)
+    date: Mapped[datetime.date] = mapped_column(Date)
+    balance: Mapped[int] = mapped_column(BigInteger)  # копейки
+
+
+# --- Запросы ---
+# Собираются один раз при импорте, значения подставляются через bindparam.
+# SUM(bigint) в Postgres возвращает numeric — приводим обратно к BigInteger.
+
+# Баланс на сегодня = последний известный баланс + лимит за каждый прошедший день.
+# Если записей нет вообще — начинаем с DAILY_LIMIT.
+_last_balance = (
+    select(Balance.balance + (bindparam("today", type_=Date) - Balance.date) * DAILY_LIMIT)
+    .where(Balance.user_id == bindparam("user_id"))
+    .order_by(Balance.date.desc())
+    .limit(1)
+    .scalar_subquery()
+)
+
+# Создаём запись на сегодня, если её ещё нет, и возвращаем баланс одним запросом.
+# DO UPDATE с тем же значением (а не DO NOTHING) нужен, чтобы RETURNING вернул строку
+# и тогда, когда её только что вставила параллельная транзакция.
+GET_BALANCE_QUERY = (
+    insert(Balance)
+    .from_select(
+        ["user_id", "date", "balance"],
+        select(
+            bindparam("user_id", type_=BigInteger),
+            bindparam("today", type_=Date),
+            func.coalesce(_last_balance, DAILY_LIMIT),
+        ),
+    )
+    .on_conflict_do_update(
+        index_elements=["user_id", "date"],
+        set_={"balance": Balance.balance},
+    )
+    .returning(Balance.balance)
+)
+
+# Списываем трату с баланса на сегодня и записываем её одним запросом.
+# Трата вставляется только из строк UPDATE: если записи баланса на сегодня нет,
+# запрос ничего не меняет и не возвращает строк — его можно безопасно повторить.
+_updated_balance = (
+    update(Balance)
+    .where(Balance.user_id == bindparam("uid"), Balance.date == bindparam("today"))
+    .values(balance=Balance.balance - bindparam("spent"))
+    .returning(Balance.balance)
+    .cte("updated_balance")
+)
+_inserted_expense = (
+    insert(Expense)
+    .from_select(
+        ["user_id", "amount", "date", "category"],
+        select(
+            bindparam("uid", type_=BigInteger),
+            bindparam("spent", type_=BigInteger),
+            bindparam("today", type_=Date),
+            bindparam("cat", type_=String),
+        ).select_from(_updated_balance),
+    )
+    .cte("inserted_expense")
+)
+ADD_EXPENSE_QUERY = select(_updated_balance.c.balance).add_cte(_inserted_expense)
+
+# Пополнение/уменьшение бюджета — относительным изменением, а не записью нового значения,
+# чтобы не затереть параллельные траты.
+ADD_TO_BUDGET_QUERY = (
+    update(Balance)
+    .where(Balance.user_id == bindparam("uid"), Balance.date == bindparam("today"))
+    .values(balance=Balance.balance + bindparam("delta"))
+    .returning(Balance.balance)
+)
+
+STATS_QUERY = (
+    select(Expense.category, cast(func.sum(Expense.amount), BigInteger))
+    .where(Expense.user_id == bindparam("user_id"), Expense.date >= bindparam("start_date"))
+    .group_by(Expense.category)
+)
+
+# Расходы и баланс за сегодня одним запросом: строки баланса помечены kind="bal"
+DAY_STATS_QUERY = union_all(
+    select(
+        literal("exp").label("kind"),
+        Expense.category.label("category"),
+        cast(func.sum(Expense.amount), BigInteger).label("amount"),
+    )
+    .where(Expense.user_id == bindparam("user_id"), Expense.date == bindparam("today"))
+    .group_by(Expense.category),
+    select(
+        literal("bal").label("kind"),
+        null().label("category"),
+        Balance.balance.label("amount"),
+    )
+    .where(Balance.user_id == bindparam("user_id"), Balance.date == bindparam("today")),
+)
+
+# Расходы по дням и категориям + балансы за эти же дни, одним запросом.
+# GROUPING SETS сразу считает итоги: level 0 — день и категория, 1 — итог дня, 3 — итог недели.
+WEEKLY_STATS_QUERY = union_all(
+    select(
+        literal("exp").label("kind"),
+        func.grouping(Expense.date, Expense.category).label("level"),
+        Expense.date.label("date"),
+        Expense.category.label("category"),
+        cast(func.sum(Expense.amount), BigInteger).label("amount"),
+    )
+    .where(Expense.user_id == bindparam("user_id"), Expense.date >= bindparam("start_date"))
+    .group_by(
+        func.grouping_sets(
+            tuple_(Expense.date, Expense.category), tuple_(Expense.date), tuple_()
+        )
+    ),
+    select(
+        literal("bal").label("kind"),
+        null().label("level"),
+        Balance.date.label("date"),
+        null().label("category"),
+        Balance.balance.label("amount"),
+    )
+    .where(Balance.user_id == bindparam("user_id"), Balance.date >= bindparam("start_date")),
+)
+WEEKLY_STATS_QUERY = WEEKLY_STATS_QUERY.order_by(WEEKLY_STATS_QUERY.selected_columns.date)
+
+LAST_BALANCE_QUERY = (
+    select(Balance.date, Balance.balance)
+    .where(Balance.user_id == bindparam("user_id"))
+    .order_by(Balance.date.desc())
+    .limit(1)
+)
+
+SPENT_TODAY_QUERY = (
+    select(cast(func.sum(Expense.amount), BigInteger))
+    .where(Expense.user_id == bindparam("user_id"), Expense.date == bindparam("today"))
+)
 
 
 # --- Клавиатуры ---
@@ -61,91 +236,83 @@ categories_kb = InlineKeyboardMarkup(inline_keyboard=[
 ])
 
 # --- Временное хранилище ---
-pending_expenses = {}  # {user_id: amount}
-awaiting_budget_add = set()
+# Незавершённые действия забываются через PENDING_TTL секунд
+pending_expenses = TTLCache(maxsize=PENDING_MAXSIZE, ttl=PENDING_TTL)  # {user_id: amount}
+awaiting_budget_add = TTLCache(maxsize=PENDING_MAXSIZE, ttl=PENDING_TTL)  # {user_id: True}
+balance_cache = OrderedDict()  # {user_id: (date, balance)}, LRU на BALANCE_CACHE_SIZE записей
 
 
-# --- Функции работы с балансом ---
-async def get_balance(session: AsyncSession, user_id: int) -> float:
-    today = date.today()
-
-    # Проверяем, есть ли баланс на сегодня
-    result = await session.execute(select(Balance).filter_by(user_id=user_id, date=today))
-    balance_today = result.scalars().first()
-    if balance_today:
-        return balance_today.balance
-
-    # Находим последний известный баланс пользователя
-    result = await session.execute(
-        select(Balance)
-        .filter(Balance.user_id == user_id)
-        .order_by(Balance.date.desc())
-        .limit(1)
-    )
-    last_balance = result.scalars().first()
+def cache_balance(user_id: int, day: date, balance: int):
+    balance_cache[user_id] = (day, balance)
+    balance_cache.move_to_end(user_id)
+    if len(balance_cache) > BALANCE_CACHE_SIZE:
+        balance_cache.popitem(last=False)
 
-    if not last_balance:
-        # Если записей нет — создаём первую запись с DAILY_LIMIT
-        new_entry = Balance(user_id=user_id, date=today, balance=DAILY_LIMIT)
-        session.add(new_entry)
-        await session.commit()
-        return DAILY_LIMIT
 
-    # Сколько дней прошло с момента последнего обновления
-    days_passed = (today - last_balance.date).days
+# --- Функции работы с балансом ---
+async def get_balance(session: AsyncSession, user_id: int, today: date) -> int:
+    """Баланс на сегодня: из кэша, а при промахе — из базы (с созданием записи на сегодня).
 
-    if days_passed <= 0:
-        # Если всё в порядке — возвращаем последний баланс
-        return last_balance.balance
+    Кэш здесь не заполняется — это делает обработчик после успешного коммита.
+    """
+    cached = balance_cache.get(user_id)
+    if cached is not None:
+        cached_date, cached_balance = cached
+        if cached_date == today:
+            balance_cache.move_to_end(user_id)
+            return cached_balance
+        # Наступил новый день — запись устарела
+        del balance_cache[user_id]
 
-    # Добавляем лимит за каждый пропущенный день
-    new_balance_value = last_balance.balance + (days_passed * DAILY_LIMIT)
+    conn = await session.connection()
+    result = await conn.execute(GET_BALANCE_QUERY, {"user_id": user_id, "today": today})
+    return result.scalar_one()
 
-    # Создаём запись на сегодня с новым балансом
-    new_entry = Balance(user_id=user_id, date=today, balance=new_balance_value)
-    session.add(new_entry)
-    await session.commit()
 
-    return new_balance_value
+async def change_balance(session: AsyncSession, user_id: int, today: date, query, params) -> int:
+    """Выполняет UPDATE баланса на сегодня и возвращает новый баланс.
 
-
-async def update_balance(session: AsyncSession, user_id: int, new_balance: float):
-    today = date.today()
-    await session.execute(
-        Balance.__table__.update()
-        .where(Balance.user_id == user_id, Balance.date == today)
-        .values(balance=new_balance)
-    )
-    await session.commit()
+    Если записи на сегодня не видно (кэш опередил коммит параллельной транзакции),
+    создаём её через GET_BALANCE_QUERY, минуя кэш, и повторяем запрос.
+    """
+    conn = await session.connection()
+    result = await conn.execute(query, params)
+    new_balance = result.scalar_one_or_none()
+    if new_balance is None:
+        await conn.execute(GET_BALANCE_QUERY, {"user_id": user_id, "today": today})
+        result = await conn.execute(query, params)
+        new_balance = result.scalar_one()
+    return new_balance
 
 
-async def add_expense(session: AsyncSession, user_id: int, amount: float, category: str):
-    today = date.today()
-    balance = await get_balance(session, user_id)
-    new_balance = balance - amount
+async def add_expense(
+    session: AsyncSession, user_id: int, today: date, amount: int, category: str
+):
+    # Гарантирует, что запись баланса на сегодня существует (обычно из кэша)
+    await get_balance(session, user_id, today)
 
-    session.add(Expense(user_id=user_id, amount=amount, date=today, category=category))
-    await update_balance(session, user_id, new_balance)
-    return new_balance
+    return await change_balance(
+        session, user_id, today, ADD_EXPENSE_QUERY,
+        {"uid": user_id, "spent": amount, "today": today, "cat": category},
+    )
 
 
-async def add_to_budget(session: AsyncSession, user_id: int, amount: float):
+async def add_to_budget(session: AsyncSession, user_id: int, today: date, amount: int):
     """
     Изменяет текущий баланс пользователя:
-    +X → добавляет X рублей
-    -X → уменьшает на X рублей
+    +X → добавляет X копеек
+    -X → уменьшает на X копеек
     """
-    current_balance = await get_balance(session, user_id)
-    new_balance = current_balance + amount  # amount может быть отрицательным
+    # Гарантирует, что запись баланса на сегодня существует (обычно из кэша)
+    await get_balance(session, user_id, today)
 
-    # Обновляем баланс в таблице
-    await update_balance(session, user_id, new_balance)
-    await session.commit()
-    return new_balance
+    return await change_balance(
+        session, user_id, today, ADD_TO_BUDGET_QUERY,
+        {"uid": user_id, "delta": amount, "today": today},  # amount может быть отрицательным
+    )
 
 
-async def get_stats(session: AsyncSession, user_id: int, period: str):
-    today = date.today()
+async def get_stats(session: AsyncSession, user_id: int, today: date, period: str):
     if period == "day":
         start_date = today
     elif period == "week":
@@ -155,94 +322,166 @@ async def get_stats(session: AsyncSession, user_id: int, period: str):
     else:
         start_date = today
 
-    query = (
-        select(Expense.category, func.sum(Expense.amount))
-        .filter(Expense.user_id == user_id, Expense.date >= start_date)
-        .group_by(Expense.category)
-    )
-
-    result = await session.execute(query)
+    # Только чтение — выполняем через Core-соединение, минуя ORM-обработку строк
+    conn = await session.connection()
+    result = await conn.execute(STATS_QUERY, {"user_id": user_id, "start_date": start_date})
     return result.all()
 
 
-async def get_weekly_stats(session: AsyncSession, user_id: int):
-    """Возвращает расходы и баланс по каждому дню за последнюю неделю."""
-    today = date.today()
+async def get_day_stats(session: AsyncSession, user_id: int, today: date):
+    """Возвращает расходы по категориям за сегодня и баланс на сегодня (или None)."""
+    conn = await session.connection()
+    result = await conn.execute(DAY_STATS_QUERY, {"user_id": user_id, "today": today})
+
+    stats = []
+    balance_today = None
+    for kind, category, amount in result:
+        if kind == "bal":
+            balance_today = amount
+        else:
+            stats.append((category, amount))
+
+    return stats, balance_today
+
+
+async def get_weekly_stats(session: AsyncSession, user_id: int, today: date):
+    """Возвращает расходы, итоги и баланс по каждому дню за последнюю неделю."""
     start_date = today - timedelta(days=6)
 
-    # --- Расходы по дням и категориям ---
-    query = (
-        select(Expense.date, Expense.category, func.sum(Expense.amount))
-        .filter(Expense.user_id == user_id, Expense.date >= start_date)
-        .group_by(Expense.date, Expense.category)
-        .order_by(Expense.date)
+    conn = await session.connection()
+    result = await conn.execute(
+        WEEKLY_STATS_QUERY, {"user_id": user_id, "start_date": start_date}
     )
-    result = await session.execute(query)
-    rows = result.all()
 
     daily_stats = {}
-    for d, cat, amount in rows:
-        if d not in daily_stats:
+    day_totals = {}
+    balances = {}
+    total_sum = 0
+    # Строки уже отсортированы по дате, поэтому daily_stats заполняется в хронологическом
+    # порядке — включая дни, где есть только баланс (для них словарь категорий пустой)
+    for kind, level, d, cat, amount in result:
+        if d is not None and d not in daily_stats:
             daily_stats[d] = {}
-        daily_stats[d][cat or "Без категории"] = amount
+        if kind == "bal":
+            balances[d] = amount
+        elif level == 0:
+            daily_stats[d][cat or "Без категории"] = amount
+        elif level == 1:
+            day_totals[d] = amount
+        else:
+            total_sum = amount or 0  # без трат итоговая строка содержит NULL
 
-    # --- Балансы за эти же дни ---
-    balance_query = (
-        select(Balance.date, Balance.balance)
-        .filter(Balance.user_id == user_id, Balance.date >= start_date)
-        .order_by(Balance.date)
-    )
-    balances_result = await session.execute(balance_query)
-    balances = {d: b for d, b in balances_result.all()}
+    return daily_stats, day_totals, balances, total_sum
 
-    total_sum = sum(sum(cats.values()) for cats in daily_stats.values())
 
-    return daily_stats, balances, total_sum
+# --- Telegram логика ---
+def orjson_dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
 
 
-# --- Telegram логика ---
-bot = Bot(token=TOKEN)
+class BotSession(AiohttpSession):
+    """HTTP-сессия бота: orjson вместо json и настроенный пул соединений к Telegram.
+
+    Статические клавиатуры сериализуются один раз и подставляются в запрос готовой строкой.
+    """
+
+    def __init__(self, static_markups=(), **kwargs):
+        super().__init__(json_loads=orjson.loads, json_dumps=orjson_dumps, **kwargs)
+        # aiogram не даёт публичного способа настроить TCPConnector
+        self._connector_init.update(limit=100, limit_per_host=50, ttl_dns_cache=600)
+        self.static_markups = {
+            id(markup): orjson_dumps(markup.model_dump(exclude_none=True))
+            for markup in static_markups
+        }
+
+    def build_form_data(self, bot, method):
+        markup_json = self.static_markups.get(id(getattr(method, "reply_markup", None)))
+        if markup_json is None:
+            return super().build_form_data(bot, method)
+        form = super().build_form_data(bot, method.model_copy(update={"reply_markup": None}))
+        form.add_field("reply_markup", markup_json)
+        return form
+
+
+bot = Bot(token=TOKEN, session=BotSession(static_markups=(menu_kb, categories_kb)))
 dp = Dispatcher()
 
 
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия на всё обновление. Обработчик сам коммитит запись до ответа в Telegram.
+
+    Заодно фиксирует сегодняшнюю дату, чтобы все запросы обработчика видели один день.
+    """
+
+    async def __call__(self, handler, event, data):
+        data["today"] = date.today()
+        try:
+            async with async_session() as session:
+                data["session"] = session
+                return await handler(event, data)
+        except Exception:
+            # После ошибки не доверяем кэшу пользователя — баланс перечитается из базы
+            user = data.get("event_from_user")
+            if user is not None:
+                balance_cache.pop(user.id, None)
+            raise
+
+
+dp.message.middleware(DbSessionMiddleware())
+dp.callback_query.middleware(DbSessionMiddleware())
+
+AMOUNT_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+def parse_amount(message: Message):
+    """Пропускает только суммы и передаёт обработчику уже разобранное значение."""
+    if message.text is None or AMOUNT_RE.fullmatch(message.text) is None:
+        return False
+    amount = round(Decimal(message.text) * 100)  # в копейках
+    if abs(amount) > MAX_AMOUNT:
+        return False
+    return {"amount": amount}
+
+
 @dp.message(F.text == "/start")
-async def start_cmd(message: Message):
-    async with async_session() as session:
-        current_balance = await get_balance(session, message.from_user.id)
+async def start_cmd(message: Message, session: AsyncSession, today: date):
+    current_balance = await get_balance(session, message.from_user.id, today)
+    await session.commit()
+    cache_balance(message.from_user.id, today, current_balance)
 
     await message.answer(
         "👋 Привет! Я помогу отслеживать твои расходы.\n"
-        f"На сегодня у тебя {current_balance:.2f} ₽.\n\n"
+        f"На сегодня у тебя {current_balance / 100:.2f} ₽.\n\n"
         "Отправь сумму, которую потратил, и выбери категорию.",
         reply_markup=menu_kb
     )
 
 
-@dp.message(F.text.regexp(r"^-?\d+(\.\d+)?$"))
-async def handle_amount(message: Message):
+@dp.message(parse_amount)
+async def handle_amount(message: Message, session: AsyncSession, today: date, amount: int):
     user_id = message.from_user.id
 
     # Проверим, ожидается ли пополнение бюджета
     if user_id in awaiting_budget_add:
-        amount = float(message.text)
-        async with async_session() as session:
-            new_balance = await add_to_budget(session, user_id, amount)
-        awaiting_budget_add.remove(user_id)
+        new_balance = await add_to_budget(session, user_id, today, amount)
+        await session.commit()
+        cache_balance(user_id, today, new_balance)
+        awaiting_budget_add.pop(user_id, None)
         sign_text = "пополнен" if amount >= 0 else "уменьшен"
         await message.answer(
-            f"✅ Бюджет {sign_text} на {abs(amount):.2f} ₽.\n"
-            f"Текущий баланс: {new_balance:.2f} ₽",
+            f"✅ Бюджет {sign_text} на {abs(amount) / 100:.2f} ₽.\n"
+            f"Текущий баланс: {new_balance / 100:.2f} ₽",
             reply_markup=menu_kb
         )
         return
 
     # Обычная трата
-    pending_expenses[user_id] = float(message.text)
+    pending_expenses[user_id] = amount
     await message.answer("Выбери категорию:", reply_markup=categories_kb)
 
 
 @dp.callback_query(F.data.startswith("cat_"))
-async def handle_category(call: CallbackQuery):
+async def handle_category(call: CallbackQuery, session: AsyncSession, today: date):
     user_id = call.from_user.id
     category = call.data.split("_", 1)[1]
     amount = pending_expenses.pop(user_id, None)
@@ -251,12 +490,13 @@ async def handle_category(call: CallbackQuery):
         await call.answer("Нет ожидающей суммы 😅", show_alert=True)
         return
 
-    async with async_session() as session:
-        new_balance = await add_expense(session, user_id, amount, category)
+    new_balance = await add_expense(session, user_id, today, amount, category)
+    await session.commit()
+    cache_balance(user_id, today, new_balance)
 
     await call.message.answer(
-        f"💸 Потратил {amount:.2f} ₽ на {category}.\n"
-        f"Остаток на сегодня: {new_balance:.2f} ₽",
+        f"💸 Потратил {amount / 100:.2f} ₽ на {category}.\n"
+        f"Остаток на сегодня: {new_balance / 100:.2f} ₽",
         reply_markup=menu_kb
     )
     await call.answer()
@@ -264,105 +504,104 @@ async def handle_category(call: CallbackQuery):
 
 @dp.callback_query(F.data == "add_budget")
 async def handle_add_budget(call: CallbackQuery):
-    awaiting_budget_add.add(call.from_user.id)
+    awaiting_budget_add[call.from_user.id] = True
     await call.message.answer("💰 Введи сумму, на которую хочешь пополнить сегодняшний бюджет:")
     await call.answer()
 
 
 @dp.callback_query(F.data.startswith("stats_"))
-async def stats_callback(call: CallbackQuery):
+async def stats_callback(call: CallbackQuery, session: AsyncSession, today: date):
     period = call.data.split("_")[1]
     names = {"day": "день", "week": "неделю", "month": "месяц"}
 
-    async with async_session() as session:
-        # ---- 📈 Статистика за неделю ----
-        if period == "week":
-            daily_stats, balances, total_sum = await get_weekly_stats(session, call.from_user.id)
-            if not daily_stats and not balances:
-                await call.message.answer("📊 За неделю расходов не найдено.", reply_markup=menu_kb)
-                await call.answer()
-                return
-
-            lines = [f"📆 Статистика за последнюю неделю:\n"]
-            sorted_days = sorted(set(daily_stats.keys()) | set(balances.keys()))
-
-            for d in sorted_days:
-                cats = daily_stats.get(d, {})
-                lines.append(f"📅 {d.strftime('%d.%m.%Y')}:")
-                if cats:
-                    for cat, amount in cats.items():
-                        lines.append(f"   • {cat}: {amount:.2f} ₽")
-                else:
-                    lines.append("   • Нет расходов")
-                day_total = sum(cats.values()) if cats else 0
-                lines.append(f"   💵 Потрачено за день: {day_total:.2f} ₽")
-
-                if d in balances:
-                    lines.append(f"   💰 Баланс на конец дня: {balances[d]:.2f} ₽\n")
-                else:
-                    lines.append("   💰 Баланс не найден\n")
-
-            lines.append(f"💵 Потрачено за неделю: {total_sum:.2f} ₽")
-            await call.message.answer("\n".join(lines), reply_markup=menu_kb)
+    # ---- 📈 Статистика за неделю ----
+    if period == "week":
+        daily_stats, day_totals, balances, total_sum = await get_weekly_stats(
+            session, call.from_user.id, today
+        )
+        if not daily_stats and not balances:
+            await call.message.answer("📊 За неделю расходов не найдено.", reply_markup=menu_kb)
             await call.answer()
             return
 
-        # ---- 📅 Статистика за день / месяц ----
-        stats = await get_stats(session, call.from_user.id, period)
-        lines = [f"📊 Статистика за {names[period]}:\n"]
-        total = 0
-        for category, amount in stats:
-            lines.append(f"• {category or 'Без категории'} — {amount:.2f} ₽")
-            total += amount
-        lines.append(f"\n💵 Потрачено: {total:.2f} ₽")
-
-        # 🔹 Добавляем баланс только если день
-        if period == "day":
-            today = date.today()
-            balance_query = await session.execute(
-                select(Balance.balance).filter_by(user_id=call.from_user.id, date=today)
-            )
-            balance_today = balance_query.scalar()
-
-            # 💡 Если нет записи — пробуем вычислить вручную
-            if balance_today is None:
-                # 1. Найти последний известный баланс
-                last_balance_query = await session.execute(
-                    select(Balance.date, Balance.balance)
-                    .filter(Balance.user_id == call.from_user.id)
-                    .order_by(Balance.date.desc())
-                    .limit(1)
-                )
-                last_balance_row = last_balance_query.first()
-
-                if last_balance_row:
-                    last_date, last_balance = last_balance_row
-                    days_passed = (today - last_date).days
-                    # 2. Сколько лимита добавилось с тех пор
-                    restored_balance = last_balance + days_passed * DAILY_LIMIT
-                else:
-                    restored_balance = DAILY_LIMIT  # если вообще нет записей
-
-                # 3. Вычитаем траты за сегодня
-                expenses_query = await session.execute(
-                    select(func.sum(Expense.amount))
-                    .filter(Expense.user_id == call.from_user.id, Expense.date == today)
-                )
-                spent_today = expenses_query.scalar() or 0
-                balance_today = restored_balance - spent_today
-
-            lines.append(f"💰 Баланс на конец дня: {balance_today:.2f} ₽")
-
-        await call.message.answer("\n".join(lines), reply_markup=menu_kb)
+        text = io.StringIO()
+        write = text.write
+        write("📆 Статистика за последнюю неделю:\n\n")
+        for d, cats in daily_stats.items():
+            write(f"📅 {d:%d.%m.%Y}:\n")
+            if cats:
+                for cat, amount in cats.items():
+                    write(f"   • {cat}: {amount / 100:.2f} ₽\n")
+            else:
+                write("   • Нет расходов\n")
+            day_total = day_totals.get(d, 0)
+            write(f"   💵 Потрачено за день: {day_total / 100:.2f} ₽\n")
+
+            if d in balances:
+                write(f"   💰 Баланс на конец дня: {balances[d] / 100:.2f} ₽\n\n")
+            else:
+                write("   💰 Баланс не найден\n\n")
+
+        write(f"💵 Потрачено за неделю: {total_sum / 100:.2f} ₽")
+        await call.message.answer(text.getvalue(), reply_markup=menu_kb)
         await call.answer()
+        return
+
+    # ---- 📅 Статистика за день / месяц ----
+    if period == "day":
+        stats, balance_today = await get_day_stats(session, call.from_user.id, today)
+    else:
+        stats = await get_stats(session, call.from_user.id, today, period)
+    text = io.StringIO()
+    write = text.write
+    write(f"📊 Статистика за {names[period]}:\n\n")
+    total = 0
+    for category, amount in stats:
+        write(f"• {category or 'Без категории'} — {amount / 100:.2f} ₽\n")
+        total += amount
+    write(f"\n💵 Потрачено: {total / 100:.2f} ₽")
+
+    # 🔹 Добавляем баланс только если день
+    if period == "day":
+        # 💡 Если нет записи — пробуем вычислить вручную
+        if balance_today is None:
+            conn = await session.connection()
+            # 1. Найти последний известный баланс
+            last_balance_query = await conn.execute(
+                LAST_BALANCE_QUERY, {"user_id": call.from_user.id}
+            )
+            last_balance_row = last_balance_query.first()
+
+            if last_balance_row:
+                last_date, last_balance = last_balance_row
+                days_passed = (today - last_date).days
+                # 2. Сколько лимита добавилось с тех пор
+                restored_balance = last_balance + days_passed * DAILY_LIMIT
+            else:
+                restored_balance = DAILY_LIMIT  # если вообще нет записей
+
+            # 3. Вычитаем траты за сегодня
+            expenses_query = await conn.execute(
+                SPENT_TODAY_QUERY, {"user_id": call.from_user.id, "today": today}
+            )
+            spent_today = expenses_query.scalar() or 0
+            balance_today = restored_balance - spent_today
+
+        write(f"\n💰 Баланс на конец дня: {balance_today / 100:.2f} ₽")
+
+    await call.message.answer(text.getvalue(), reply_markup=menu_kb)
+    await call.answer()
 
 
 # --- Запуск ---
 async def main():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Схема создаётся только по запросу; в проде её накатывают миграциями из migrations/
+    if RUN_DDL:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # Цикл событий на libuv вместо стандартного selector-цикла asyncio
+    uvloop.run(main())
\ No newline at end of file
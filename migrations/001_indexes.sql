@@ -0,0 +1,50 @@
+-- Индексы для баз, созданных до появления __table_args__ в моделях.
+-- Новые базы получают их через Base.metadata.create_all.
+-- CONCURRENTLY нельзя выполнять внутри транзакции: запускать через psql без -1.
+
+-- Старый get_balance мог создать несколько записей на один день — оставляем последнюю.
+DELETE FROM balances b
+    USING balances newer
+    WHERE b.user_id = newer.user_id
+      AND b.date = newer.date
+      AND b.id < newer.id;
+
+-- Неудачный CREATE INDEX CONCURRENTLY оставляет невалидный индекс — убираем его.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = 'uq_balances_user_date' AND NOT i.indisvalid
+    ) THEN
+        DROP INDEX uq_balances_user_date;
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_balances_user_date
+    ON balances (user_id, date);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint WHERE conname = 'uq_balances_user_date'
+    ) THEN
+        ALTER TABLE balances
+            ADD CONSTRAINT uq_balances_user_date UNIQUE USING INDEX uq_balances_user_date;
+    END IF;
+END $$;
+
+-- Пересоздаём индекс по тратам, только если он невалидный или без INCLUDE-колонок
+-- (2 ключевые колонки + category, amount) — рабочий покрывающий индекс не трогаем.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = 'ix_expenses_user_date'
+          AND (NOT i.indisvalid OR i.indnkeyatts <> 2 OR i.indnatts <> 4)
+    ) THEN
+        DROP INDEX ix_expenses_user_date;
+    END IF;
+END $$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_expenses_user_date
+    ON expenses (user_id, date) INCLUDE (category, amount);
@@ -0,0 +1,24 @@
+-- Суммы и балансы хранятся в копейках (bigint) вместо рублей (double precision).
+-- Каждая колонка конвертируется только если она ещё double precision,
+-- поэтому повторный запуск ничего не меняет.
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'expenses' AND column_name = 'amount'
+          AND data_type = 'double precision'
+    ) THEN
+        ALTER TABLE expenses
+            ALTER COLUMN amount TYPE bigint USING round(amount * 100)::bigint;
+    END IF;
+
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'balances' AND column_name = 'balance'
+          AND data_type = 'double precision'
+    ) THEN
+        ALTER TABLE balances
+            ALTER COLUMN balance TYPE bigint USING round(balance * 100)::bigint;
+    END IF;
+END $$;